@@ -23,5 +23,5 @@ setup(
     license='LICENSE',
     description=('CNV analysis tools'),
     long_description=(LONG_DESCRIPTION),
-    install_requires=["networkx", "bx-python", "scipy"]
+    install_requires=["networkx", "ncls", "numpy", "pandas", "scipy"]
 )
@@ -29,17 +29,20 @@ import logging
 import pkg_resources
 import networkx as nx
 import csv
-from collections import namedtuple
+from collections import namedtuple, defaultdict, deque
 from itertools import combinations
-from bx.intervals.intersection import Interval, IntervalTree
-import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ncls import NCLS
 import os
 from pathlib import Path 
-from scipy.stats import chi2_contingency
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2 as chi2_distribution
 
 
 EXIT_FILE_IO_ERROR = 1
 EXIT_COMMAND_LINE_ERROR = 2
+EXIT_INPUT_ERROR = 3
 PROGRAM_NAME = "case_control_cnvs"
 
 
@@ -117,140 +120,360 @@ def init_logging(log_filename):
 CNV = namedtuple('CNV', ['chrom', 'start', 'end', 'copynumber', 'genes', 'penncnv_conf'])
 
 
+# Many CNVs share the same list of genes, so only make one tuple for each.
+GENE_TUPLES = {}
+
+
+def gene_tuple(genes):
+    '''Convert a semicolon separated string of genes into a tuple,
+    returning the same tuple object for equal strings.
+    '''
+    result = GENE_TUPLES.get(genes)
+    if result is None:
+        result = tuple(genes.split(';'))
+        GENE_TUPLES[genes] = result
+    return result
+
+
+# All the chromosomes of a family are laid end to end in one coordinate
+# space, so that the CNVs of the whole family can be intersected in a single
+# batch. Each chromosome is shifted by a different multiple of CHROM_OFFSET,
+# which is larger than any chromosome.
+CHROM_OFFSET = 1 << 32
+
+
+def exit_with_coordinate_error(filename, chrom, start, end):
+    '''Exit the program because a CNV has coordinates which do not fit in
+    the space reserved for its chromosome.
+    '''
+    exit_with_error("CNV {}:{}-{} in {} has coordinates outside the supported range 0 to {}".format(
+        chrom, start, end, filename, CHROM_OFFSET - 1), EXIT_INPUT_ERROR)
+
+
+# Merged CNVs in a single family. chrom_offsets maps each chromosome to the
+# amount its coordinates are shifted by. The starts and ends are parallel
+# numpy arrays of the shifted coordinates of the CNVs in the cnvs list.
+FAMILY_CNVS = namedtuple('FAMILY_CNVS', ['chrom_offsets', 'starts', 'ends', 'cnvs'])
+
+
+MERGED_CNV_DTYPES = {
+    'chr': str,
+    'start': np.int64,
+    'end': np.int64,
+    'family': str,
+    'copy_number': np.int64,
+    'genes': str,
+    'penncnv_conf': np.float64,
+}
+
+
 def read_merged_cnvs(pool, merged_cnvs_filename):
+    merged = pd.read_csv(merged_cnvs_filename, sep='\t', usecols=list(MERGED_CNV_DTYPES),
+                         dtype=MERGED_CNV_DTYPES, na_filter=False, float_precision="round_trip")
+    out_of_range = (merged['start'] < 0) | (merged['start'] >= CHROM_OFFSET) | \
+                   (merged['end'] < 0) | (merged['end'] >= CHROM_OFFSET)
+    if out_of_range.any():
+        bad_cnv = merged[out_of_range].iloc[0]
+        exit_with_coordinate_error(merged_cnvs_filename, bad_cnv['chr'], bad_cnv['start'], bad_cnv['end'])
+    if pool:
+        merged['family'] = "EVERYONE"
     families = {}
-    with open(merged_cnvs_filename) as file:
-        reader = csv.DictReader(file, delimiter='\t')
-        for row in reader:
-            if pool:
-                this_family = "EVERYONE"
-            else:
-                this_family = row['family']
-            if this_family not in families:
-                families[this_family] = {}
-            chroms = families[this_family]
-            this_chrom = row['chr']
-            this_start = int(row['start'])
-            this_end = int(row['end'])
-            this_copynumber = int(row['copy_number'])
-            this_genes = tuple(row['genes'].split(';'))
-            this_conf = float(row['penncnv_conf'])
-            this_cnv = CNV(this_chrom, this_start, this_end, this_copynumber, this_genes, this_conf)
-            if this_chrom not in chroms:
-                chroms[this_chrom] = IntervalTree() 
-            chroms[this_chrom].insert(this_start, this_end, this_cnv)
+    for this_family, group in merged.groupby('family', sort=False):
+        chrom_codes, chroms = pd.factorize(group['chr'])
+        offsets = chrom_codes.astype(np.int64) * CHROM_OFFSET
+        starts = group['start'].to_numpy()
+        ends = group['end'].to_numpy()
+        cnvs = [CNV(this_chrom, this_start, this_end, this_copynumber, gene_tuple(this_genes), this_conf)
+                for this_chrom, this_start, this_end, this_copynumber, this_genes, this_conf in
+                zip(group['chr'].tolist(), starts.tolist(), ends.tolist(), group['copy_number'].tolist(),
+                    group['genes'].tolist(), group['penncnv_conf'].tolist())]
+        chrom_offsets = {this_chrom: code * CHROM_OFFSET for code, this_chrom in enumerate(chroms)}
+        families[this_family] = FAMILY_CNVS(chrom_offsets, starts + offsets, ends + offsets, cnvs)
     return families 
 
 
-class CasesControls(object):
-    def __init__(self):
-        self.cases = set()
-        self.controls = set()
+# The cases and controls of a family are a pair of sets of sample ids,
+# indexed by CASES and CONTROLS.
+CASES, CONTROLS = 0, 1
+
+
+def new_cases_controls():
+    return (set(), set())
+
+
+READ_CHUNK_SIZE = 4 << 20
+
+
+def read_lines(filename, chunk_size=READ_CHUNK_SIZE):
+    '''Generate the lines of a file as bytes, without line endings.
+
+    The file is read in large chunks with os.read. The next chunk is read
+    in a background thread while the lines of the current chunk are being
+    consumed; os.read releases the GIL, so reading and parsing overlap.
+
+    Arguments:
+        filename: the name of the file to read.
+        chunk_size: the number of bytes to read at a time.
+    Result:
+        A generator of lines, each a bytes object.
+    '''
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as read_ahead:
+            next_chunk = read_ahead.submit(os.read, fd, chunk_size)
+            partial_line = b''
+            while True:
+                chunk = next_chunk.result()
+                if not chunk:
+                    break
+                next_chunk = read_ahead.submit(os.read, fd, chunk_size)
+                lines = (partial_line + chunk).split(b'\n')
+                partial_line = lines.pop()
+                for line in lines:
+                    yield line.rstrip(b'\r')
+            if partial_line:
+                yield partial_line.rstrip(b'\r')
+    finally:
+        os.close(fd)
+
+
+# The fields of a (non-duplicate) CNV from the all CNVs file which are
+# needed for the case-control analysis.
+ALL_CNV = namedtuple('ALL_CNV', ['sample_id', 'affected', 'chrom', 'start', 'end'])
+
 
 def read_all_cnvs(all_cnvs_filename, pool=False):
-    families = {}
+    families = defaultdict(list)
     seen_samples = {} 
     duplicates = []
-    cases_controls = {}
-    with open(all_cnvs_filename) as file:
-        reader = csv.DictReader(file, delimiter='\t')
-        header = reader.fieldnames 
-        for row in reader:
-            if pool:
-                this_family = "EVERYONE"
-            else:
-                this_family = row['master_sample_sheet_FAMILY_ID']
-            this_sample_id = row['sample_id']
-            if this_family not in cases_controls:
-                cases_controls[this_family] = CasesControls()
-            if row['ped_Affected'] == "Yes":
-                cases_controls[this_family].cases.add(this_sample_id)
-            else:
-                cases_controls[this_family].controls.add(this_sample_id)
-            this_sentrix_id = row['sentrix_id']
-            if this_sample_id not in seen_samples:
-                seen_samples[this_sample_id] = this_sentrix_id
-            if this_sentrix_id == seen_samples[this_sample_id]:
-                # not a duplicate
-                if this_family not in families:
-                    families[this_family] = []
-                families[this_family].append(row)
-            else:
-                duplicates.append(row)
-        return header, duplicates, families, cases_controls
+    cases_controls = defaultdict(new_cases_controls)
+    lines = read_lines(all_cnvs_filename)
+    header = next(lines, b'')
+    fieldnames = header.decode().split('\t')
+    if not pool:
+        family_index = fieldnames.index('master_sample_sheet_FAMILY_ID')
+    sample_index = fieldnames.index('sample_id')
+    affected_index = fieldnames.index('ped_Affected')
+    sentrix_index = fieldnames.index('sentrix_id')
+    chrom_index = fieldnames.index('chr')
+    start_index = fieldnames.index('coord_start')
+    end_index = fieldnames.index('coord_end')
+    for line in lines:
+        if not line:
+            continue
+        fields = line.split(b'\t')
+        if pool:
+            this_family = "EVERYONE"
+        else:
+            this_family = fields[family_index].decode()
+        this_sample_id, this_affected, this_sentrix_id = \
+            fields[sample_index].decode(), fields[affected_index] == b"Yes", fields[sentrix_index]
+        cases_controls[this_family][CASES if this_affected else CONTROLS].add(this_sample_id)
+        if this_sentrix_id == seen_samples.setdefault(this_sample_id, this_sentrix_id):
+            # not a duplicate
+            this_chrom, this_start, this_end = fields[chrom_index].decode(), int(fields[start_index]), int(fields[end_index])
+            if not (0 <= this_start < CHROM_OFFSET and 0 <= this_end < CHROM_OFFSET):
+                exit_with_coordinate_error(all_cnvs_filename, this_chrom, this_start, this_end)
+            families[this_family].append(ALL_CNV(this_sample_id, this_affected, this_chrom, this_start, this_end))
+        else:
+            duplicates.append(line)
+    return header, duplicates, families, cases_controls
 
 
 SAMPLE = namedtuple('SAMPLE', ['id', 'affected'])
 
 
+def bx_order(query_indices, tree_indices, tree_starts, tree_ends):
+    '''Sort the overlaps found by NCLS into the order the old bx-python
+    IntervalTree produced: by query, then by the start of the overlapping
+    interval. bx-python broke ties between intervals with the same start
+    by insertion order, except that a zero-length interval was placed ahead
+    of all the same-start intervals inserted before it.
+
+    Arguments:
+        query_indices, tree_indices: parallel numpy arrays of overlapping
+            (query, tree interval) index pairs, as returned by
+            NCLS.all_overlaps_both. Tree interval indices are in insertion
+            order.
+        tree_starts, tree_ends: numpy arrays of the tree interval coordinates.
+    Result:
+        The query_indices and tree_indices arrays in bx-python order.
+    '''
+    hit_starts = tree_starts[tree_indices]
+    non_empty = tree_ends[tree_indices] > hit_starts
+    insertion_order = np.where(non_empty, tree_indices, -tree_indices)
+    order = np.lexsort((insertion_order, non_empty, hit_starts, query_indices))
+    return query_indices[order], tree_indices[order]
+
+
 def intersect_cnvs(merged_cnvs, all_cnvs):
     result = {}
+    # share a single SAMPLE object between all the CNVs of a sample
+    sample_cache = {}
     for family_id, this_family_cnvs in all_cnvs.items():
-        if family_id not in result:
-            result[family_id] = {}
-        this_family_result = result[family_id]
+        # merged CNV -> [positive cases, positive controls, samples]
+        this_family_result = {}
+        result[family_id] = this_family_result
         if family_id in merged_cnvs:
             this_merged_cnvs = merged_cnvs[family_id]
+            chrom_offsets = this_merged_cnvs.chrom_offsets
+            starts, ends, samples = [], [], []
             for this_cnv in this_family_cnvs:
-                this_affected = this_cnv['ped_Affected'] == "Yes"
-                this_sample = SAMPLE(this_cnv['sample_id'], this_affected)
-                this_chrom = this_cnv['chr']
-                if this_chrom in this_merged_cnvs:
-                    this_interval_tree = this_merged_cnvs[this_chrom]
-                    this_intersection = this_interval_tree.find(int(this_cnv['coord_start']), int(this_cnv['coord_end']))
-                    for intersecting_cnv in this_intersection:
-                        if intersecting_cnv not in this_family_result:
-                            this_family_result[intersecting_cnv] = set()
-                        this_family_result[intersecting_cnv].add(this_sample)
+                this_offset = chrom_offsets.get(this_cnv.chrom)
+                if this_offset is not None:
+                    this_sample_key = (this_cnv.sample_id, this_cnv.affected)
+                    this_sample = sample_cache.get(this_sample_key)
+                    if this_sample is None:
+                        this_sample = SAMPLE(*this_sample_key)
+                        sample_cache[this_sample_key] = this_sample
+                    starts.append(this_cnv.start + this_offset)
+                    ends.append(this_cnv.end + this_offset)
+                    samples.append(this_sample)
+            if not samples:
+                continue
+            # intersect all the CNVs of the family against the merged CNVs in one batch
+            this_tree = NCLS(this_merged_cnvs.starts, this_merged_cnvs.ends,
+                             np.arange(len(this_merged_cnvs.cnvs), dtype=np.int64))
+            query_indices, tree_indices = this_tree.all_overlaps_both(
+                np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.arange(len(samples), dtype=np.int64))
+            query_indices, tree_indices = bx_order(query_indices, tree_indices,
+                                                   this_merged_cnvs.starts, this_merged_cnvs.ends)
+            for query_index, tree_index in zip(query_indices.tolist(), tree_indices.tolist()):
+                intersecting_cnv = this_merged_cnvs.cnvs[tree_index]
+                this_sample = samples[query_index]
+                entry = this_family_result.get(intersecting_cnv)
+                if entry is None:
+                    entry = [0, 0, set()]
+                    this_family_result[intersecting_cnv] = entry
+                if this_sample not in entry[2]:
+                    entry[2].add(this_sample)
+                    entry[0 if this_sample.affected else 1] += 1
     return result
 
 
-def write_duplicates(fieldnames, duplicates, input_filename):
+def write_duplicates(header, duplicates, input_filename):
     input_path = Path(input_filename)
     output_filepath = input_path.with_suffix(".dups.tsv")
-    with output_filepath.open("w") as output_file:
-        writer = csv.DictWriter(output_file, fieldnames, delimiter="\t")
-        writer.writeheader()
-        for row in duplicates:
-            writer.writerow(row)
+    with output_filepath.open("wb") as output_file:
+        output_file.write(header + b"\n")
+        for line in duplicates:
+            output_file.write(line + b"\n")
 
 
 
-def affected_str(is_affected):
-    if is_affected:
-        return "CASE"
-    else:
-        return "CONTROL"
+AFFECTED_STR = {True: "CASE", False: "CONTROL"}
+
+
+OUTPUT_HEADER = ["chr", "start", "end", "family", "positive cases", "negative cases","postive controls","negative controls", "chi2", "p-value", "penncnv_conf", "copynumber", "genes", "samples"]
 
 
 def write_family_intersections(cnv_significances):
-    header = '\t'.join(["chr", "start", "end", "family", "positive cases", "negative cases","postive controls","negative controls", "chi2", "p-value", "penncnv_conf", "copynumber", "genes", "samples"])
-    print(header)
-    for family_id, pos_cases, neg_cases, pos_controls, neg_controls, chi2, p, penncnv_conf, chrom, start, end, copynumber, genes, samples in cnv_significances: 
-        gene_string = ";".join(genes)
-        sample_string = "|".join([";".join([s.id, affected_str(s.affected)]) for s in samples])
-        print("\t".join([chrom, str(start), str(end), family_id, str(pos_cases), str(neg_cases), str(pos_controls), str(neg_controls), str(chi2), str(p), str(penncnv_conf), str(copynumber), gene_string, sample_string]))
+    writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+    writer.writerow(OUTPUT_HEADER)
+    writer.writerows(
+        [chrom, start, end, family_id, pos_cases, neg_cases, pos_controls, neg_controls, chi2, p, penncnv_conf, copynumber,
+         ";".join(genes), "|".join([s.id + ";" + AFFECTED_STR[s.affected] for s in samples])]
+        for family_id, pos_cases, neg_cases, pos_controls, neg_controls, chi2, p, penncnv_conf, chrom, start, end, copynumber, genes, samples in cnv_significances)
+
+
+def chi2_2x2(a, b, c, d):
+    '''Pearson's chi-squared test, with Yates' continuity correction, for a
+    batch of 2x2 contingency tables [[a, b], [c, d]].
+
+    Gives the same answer as calling scipy.stats.chi2_contingency on each
+    table, but uses the closed-form solution for the 2x2 case so that all
+    tables are computed with a handful of numpy operations. Tables with
+    a zero marginal total (which chi2_contingency rejects with a ValueError)
+    get chi2 = 0.0 and p = 1.0.
+
+    Arguments:
+        a, b, c, d: equal length numpy integer arrays of cell counts.
+    Result:
+        A pair of numpy float arrays (chi2, p).
+    '''
+    a, b, c, d = [x.astype(np.float64) for x in (a, b, c, d)]
+    n = a + b + c + d
+    denominator = (a + b) * (c + d) * (a + c) * (b + d)
+    valid = (denominator > 0) & (a >= 0) & (b >= 0) & (c >= 0) & (d >= 0)
+    difference = np.maximum(np.abs(a * d - b * c) - n / 2.0, 0.0)
+    chi2 = np.divide(n * difference ** 2, denominator, out=np.zeros(len(n)), where=valid)
+    p = np.ones(len(n))
+    p[valid] = chi2_distribution.sf(chi2[valid], 1)
+    return chi2, p
 
 
 def get_significance(cases_controls, family_intersections):
-    result = []
+    counts = []
+    cnv_info = []
     for family_id, cnvs in family_intersections.items():
-        this_cases_controls = cases_controls[family_id]
-        total_cases = len(this_cases_controls.cases)
-        total_controls = len(this_cases_controls.controls)
-        for this_cnv, samples in cnvs.items():
-            positive_cases = len([s for s in samples if s.affected])
-            positive_controls = len([s for s in samples if not s.affected])
+        cases, controls = cases_controls[family_id]
+        total_cases = len(cases)
+        total_controls = len(controls)
+        for this_cnv, (positive_cases, positive_controls, samples) in cnvs.items():
             negative_cases = total_cases - positive_cases
             negative_controls = total_controls - positive_controls
-            try:
-                (chi2, p, dof, ex) = chi2_contingency([[positive_cases, positive_controls], [negative_cases, negative_controls]])
-            except ValueError:
-                chi2 = 0.0
-                p = 1.0
-            this_result = [family_id, positive_cases, negative_cases, positive_controls, negative_controls, chi2, p, this_cnv.penncnv_conf, this_cnv.chrom, this_cnv.start, this_cnv.end, this_cnv.copynumber, this_cnv.genes, samples]
-            result.append(this_result)
-    return result
+            counts.append((positive_cases, positive_controls, negative_cases, negative_controls))
+            cnv_info.append((family_id, this_cnv, samples))
+    count_array = np.array(counts, dtype=np.int64).reshape(-1, 4)
+    chi2s, ps = chi2_2x2(count_array[:, 0], count_array[:, 1], count_array[:, 2], count_array[:, 3])
+    for (family_id, this_cnv, samples), (positive_cases, positive_controls, negative_cases, negative_controls), chi2, p in \
+            zip(cnv_info, counts, chi2s.tolist(), ps.tolist()):
+        this_result = [family_id, positive_cases, negative_cases, positive_controls, negative_controls, chi2, p, this_cnv.penncnv_conf, this_cnv.chrom, this_cnv.start, this_cnv.end, this_cnv.copynumber, this_cnv.genes, samples]
+        yield this_result
+
+
+def family_significance(family_id, family_cnvs, family_merged_cnvs, family_cases_controls):
+    '''Intersect and test the significance of the CNVs of a single family.
+
+    Result:
+        A generator of the significance results for the family, as produced
+        by get_significance.
+    '''
+    if family_merged_cnvs is None:
+        merged_cnvs = {}
+    else:
+        merged_cnvs = {family_id: family_merged_cnvs}
+    family_intersections = intersect_cnvs(merged_cnvs, {family_id: family_cnvs})
+    return get_significance({family_id: family_cases_controls}, family_intersections)
+
+
+def process_family(family_id, family_cnvs, family_merged_cnvs, family_cases_controls):
+    '''Run family_significance in a worker process, returning its results
+    as a list so they can be sent back to the main process.
+    '''
+    return list(family_significance(family_id, family_cnvs, family_merged_cnvs, family_cases_controls))
+
+
+# Number of families queued in the worker pool at once, per worker. This
+# bounds the number of family results held in memory while keeping the
+# workers busy.
+FAMILIES_PER_WORKER = 4
+
+
+def get_all_significances(families, merged_cnvs, cases_controls):
+    '''Generate the significance results of all families, in family order.
+
+    Families are independent of each other, so when there is more than one
+    family and more than one CPU they are processed in a pool of worker
+    processes. Only a bounded number of families are in flight at once, so
+    results are streamed rather than all held in memory.
+    '''
+    family_args = ((f, families[f], merged_cnvs.get(f), cases_controls[f]) for f in families)
+    num_workers = os.cpu_count() or 1
+    if len(families) <= 1 or num_workers <= 1:
+        for args in family_args:
+            yield from family_significance(*args)
+        return
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for args in family_args:
+            pending.append(executor.submit(process_family, *args))
+            if len(pending) >= num_workers * FAMILIES_PER_WORKER:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
 
 def main():
@@ -260,9 +483,7 @@ def main():
     merged_cnvs = read_merged_cnvs(options.pool, options.merged)
     header, duplicates, families, cases_controls = read_all_cnvs(options.all, options.pool)
     write_duplicates(header, duplicates, options.all)
-    family_intersections = intersect_cnvs(merged_cnvs, families)
-    cnv_significances = get_significance(cases_controls, family_intersections)
-    write_family_intersections(cnv_significances)
+    write_family_intersections(get_all_significances(families, merged_cnvs, cases_controls))
 
 
 # If this script is run from the command line then call the main function.
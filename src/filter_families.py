@@ -14,7 +14,6 @@ from argparse import ArgumentParser
 import sys
 import logging
 import pkg_resources
-import csv
 
 
 EXIT_FILE_IO_ERROR = 1
@@ -86,14 +85,18 @@ def init_logging(log_filename):
 
 
 def filter_cnvs(filename):
+    # Rows are passed through unchanged, so there is no need to parse them
+    # into dictionaries; just look at the two columns of interest.
     with open(filename) as file:
-        reader = csv.DictReader(file, delimiter="\t")
-        fieldnames = reader.fieldnames
-        writer = csv.DictWriter(sys.stdout, fieldnames, delimiter="\t")
-        writer.writeheader()
-        for row in reader:
-            if row['cancer_CRC_affected_youngest_affected_in_family'] == "1" or row['population_sample'] == "1":
-                writer.writerow(row)
+        header = next(file, '')
+        sys.stdout.write(header)
+        fieldnames = header.rstrip('\r\n').split('\t')
+        youngest_affected_index = fieldnames.index('cancer_CRC_affected_youngest_affected_in_family')
+        population_index = fieldnames.index('population_sample')
+        for line in file:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[youngest_affected_index] == "1" or fields[population_index] == "1":
+                sys.stdout.write(line)
 
 
 def main():
@@ -15,13 +15,12 @@ from argparse import ArgumentParser
 import sys
 import logging
 import pkg_resources
-import networkx as nx
 import csv
-from collections import namedtuple
-from itertools import combinations
-import json
+from collections import namedtuple, defaultdict
+from itertools import combinations, repeat
+from concurrent.futures import ProcessPoolExecutor
 import os
-import networkx as nx
+import xml.etree.ElementTree as ET
 
 
 EXIT_FILE_IO_ERROR = 1
@@ -102,14 +101,27 @@ def init_logging(log_filename):
 CNV = namedtuple('CNV', ['chrom', 'start', 'end', 'copynumber', 'chi2', 'p', 'penncnv_conf', 'genes'])
 
 
+# Many CNVs share the same list of genes, so only make one tuple for each.
+GENE_TUPLES = {}
+
+
+def gene_tuple(genes):
+    '''Convert a semicolon separated string of genes into a tuple,
+    returning the same tuple object for equal strings.
+    '''
+    result = GENE_TUPLES.get(genes)
+    if result is None:
+        result = tuple(genes.split(';'))
+        GENE_TUPLES[genes] = result
+    return result
+
+
 def read_all_cnvs(all_cnvs_filename):
-    families = {}
+    families = defaultdict(list)
     with open(all_cnvs_filename) as file:
         reader = csv.DictReader(file, delimiter='\t')
         for row in reader:
             this_family = row['family']
-            if this_family not in families:
-                families[this_family] = []
             families[this_family].append(row)
     return families 
 
@@ -125,33 +137,73 @@ def write_family_results(outdir, family, cnvs):
     unique_samples = set()
     unique_cnvs = {}
     unique_edges = set()
-    graph = nx.Graph() 
     for row in cnvs:
         this_samples = [make_sample(sample_info) for sample_info in row['samples'].split('|')]
         for s in this_samples:
             unique_samples.add(s)
-        this_genes = tuple(row['genes'].split(';'))
+        this_genes = gene_tuple(row['genes'])
         this_cnv = CNV(row['chr'], row['start'], row['end'], row['copynumber'], row['chi2'], row['p-value'], row['penncnv_conf'], this_genes)
         if this_cnv not in unique_cnvs:
             unique_cnvs[this_cnv] = cnv_id
             cnv_id += 1
         for sample in this_samples:
             unique_edges.add((sample.id, str(unique_cnvs[this_cnv])))
+    # node id -> attributes; a node added twice has its attributes merged
+    nodes = defaultdict(dict)
     for sample in unique_samples:
         node_id = sample.id
         if sample.affected == "CASE":
             this_name = "+"
         else:
             this_name = "-"
-        graph.add_node(node_id, name=this_name, type=sample.affected)
+        nodes[node_id].update(name=this_name, type=sample.affected)
     for cnv, cnv_id in unique_cnvs.items():
         node_id = str(cnv_id)
-        node = graph.add_node(node_id, name=cnv.genes[0], genes=";".join(cnv.genes), type='CNV' + str(cnv.copynumber), p=float(cnv.p), chi2=float(cnv.chi2), penncnv_conf=float(cnv.penncnv_conf))
-    for source, target in unique_edges:
-        graph.add_edge(source, target)
+        nodes[node_id].update(name=cnv.genes[0], genes=";".join(cnv.genes), type='CNV' + str(cnv.copynumber), p=float(cnv.p), chi2=float(cnv.chi2), penncnv_conf=float(cnv.penncnv_conf))
 
     outfilename = os.path.join(outdir, family + ".graphml")
-    nx.write_graphml(graph, outfilename, prettyprint=True, infer_numeric_types=True)
+    write_graphml(outfilename, nodes, unique_edges)
+
+
+# Name and GraphML type of each node attribute, in output order.
+NODE_ATTRIBUTES = [('name', 'string'), ('type', 'string'), ('genes', 'string'),
+                   ('p', 'double'), ('chi2', 'double'), ('penncnv_conf', 'double')]
+
+GRAPHML_HEADER = b'''<?xml version='1.0' encoding='utf-8'?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+'''
+
+
+def write_graphml(outfilename, nodes, edges):
+    '''Write an undirected graph to a file in GraphML format.
+
+    The file is written one element at a time, with the attribute types
+    declared up front from NODE_ATTRIBUTES, rather than building the whole
+    document in memory.
+
+    Arguments:
+        outfilename: the name of the output file.
+        nodes: a dictionary mapping node ids to dictionaries of node
+            attributes, keyed by the names in NODE_ATTRIBUTES.
+        edges: an iterable of (source, target) node id pairs.
+    Result:
+        None
+    '''
+    with open(outfilename, 'wb') as outfile:
+        outfile.write(GRAPHML_HEADER)
+        for key, attr_type in NODE_ATTRIBUTES:
+            key_element = ET.Element('key', {'id': key, 'for': 'node', 'attr.name': key, 'attr.type': attr_type})
+            outfile.write(ET.tostring(key_element) + b'\n')
+        outfile.write(b'<graph edgedefault="undirected">\n')
+        for node_id, attributes in nodes.items():
+            node_element = ET.Element('node', id=node_id)
+            for key, _attr_type in NODE_ATTRIBUTES:
+                if key in attributes:
+                    ET.SubElement(node_element, 'data', key=key).text = str(attributes[key])
+            outfile.write(ET.tostring(node_element) + b'\n')
+        for source, target in edges:
+            outfile.write(ET.tostring(ET.Element('edge', source=source, target=target)) + b'\n')
+        outfile.write(b'</graph>\n</graphml>\n')
 
 
 def make_output_directory(directory_name):
@@ -160,8 +212,18 @@ def make_output_directory(directory_name):
 
 
 def make_graphs(outdir, family_cnvs):
-    for family, cnvs in family_cnvs.items():
-        write_family_results(outdir, family, cnvs)
+    # each family is written to its own file, so they can be done in parallel,
+    # unless there is only one family or one CPU, when a worker pool would
+    # only add the cost of sending the rows to it
+    families = list(family_cnvs)
+    num_workers = os.cpu_count() or 1
+    if len(families) <= 1 or num_workers <= 1:
+        for family in families:
+            write_family_results(outdir, family, family_cnvs[family])
+        return
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for _ in executor.map(write_family_results, repeat(outdir), families, [family_cnvs[f] for f in families]):
+            pass
 
 def main():
     "Orchestrate the execution of the program"
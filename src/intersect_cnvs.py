@@ -14,8 +14,10 @@ import sys
 import logging
 import pkg_resources
 import csv
-from collections import namedtuple
-from bx.intervals.intersection import Interval, IntervalTree
+from collections import namedtuple, defaultdict
+from operator import itemgetter
+from ncls import NCLS
+import numpy as np
 import os
 from pathlib import Path 
 
@@ -92,45 +94,103 @@ def init_logging(log_filename):
         logging.info('command line: %s', ' '.join(sys.argv))
 
 
+# Genes on a single chromosome. The tree is an NCLS index over the
+# coordinates of the genes, where the id of each interval is its position
+# in the genes list. starts and ends hold the coordinates of each gene.
+CHROM_GENES = namedtuple('CHROM_GENES', ['tree', 'starts', 'ends', 'genes'])
+
+
+get_gene_numbers = itemgetter('GRCh37 start', 'GRCh37 end', 'tier')
+get_cnv_coordinates = itemgetter('start', 'end')
+
+
 def read_genes(filename):
-    chroms = {}
+    chroms = defaultdict(lambda: ([], [], []))
     with open(filename) as file:
         reader = csv.DictReader(file, delimiter="\t")
         for row in reader:
             try:
                 chrom = row['chromosome']
-                start = int(row['GRCh37 start'])
-                end = int(row['GRCh37 end'])
+                start, end, tier = map(int, get_gene_numbers(row))
                 symbol = row['symbol']
-                tier = int(row['tier'])
-                if chrom not in chroms:
-                    chroms[chrom] = IntervalTree()
-                chroms[chrom].insert(start, end, (symbol, tier))
+                starts, ends, genes = chroms[chrom]
+                starts.append(start)
+                ends.append(end)
+                genes.append((symbol, tier))
             except:
                 pass
-    return chroms
+    result = {}
+    for chrom, (starts, ends, genes) in chroms.items():
+        tree = NCLS(np.array(starts, dtype=np.int64),
+                    np.array(ends, dtype=np.int64),
+                    np.arange(len(genes), dtype=np.int64))
+        result[chrom] = CHROM_GENES(tree, starts, ends, genes)
+    return result
+
+
+def bx_order(start, end, index):
+    '''Sort key giving the order in which the old bx-python IntervalTree
+    reported overlapping intervals: by start, then by insertion index,
+    except that a zero-length interval comes ahead of all the same-start
+    intervals inserted before it.
+    '''
+    if end > start:
+        return (start, 1, index)
+    else:
+        return (start, 0, -index)
+
+
+def find_gene_matches(genes, rows):
+    '''Intersect the coordinates of each CNV row with the genes, one batch
+    per chromosome.
+
+    Result:
+        A dictionary mapping the index of each row that overlaps at least
+        one gene to the list of (symbol, tier) pairs it overlaps, in the
+        order the old bx-python IntervalTree reported them (see bx_order).
+    '''
+    queries = defaultdict(lambda: ([], [], []))
+    for index, row in enumerate(rows):
+        chrom = row['chr']
+        if chrom in genes:
+            start, end = map(int, get_cnv_coordinates(row))
+            starts, ends, indices = queries[chrom]
+            starts.append(start)
+            ends.append(end)
+            indices.append(index)
+    matches = defaultdict(list)
+    for chrom, (starts, ends, indices) in queries.items():
+        tree, gene_starts, gene_ends, chrom_genes = genes[chrom]
+        query_indices, gene_indices = tree.all_overlaps_both(
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            np.array(indices, dtype=np.int64))
+        for query_index, gene_index in zip(query_indices.tolist(), gene_indices.tolist()):
+            matches[query_index].append(gene_index)
+        for query_index in set(query_indices.tolist()):
+            gene_order = sorted(matches[query_index], key=lambda i: bx_order(gene_starts[i], gene_ends[i], i))
+            matches[query_index] = [chrom_genes[i] for i in gene_order]
+    return matches
 
 
 def filter_cnvs(genes, filename):
     with open(filename) as file:
         reader = csv.DictReader(file, delimiter="\t")
         fieldnames = reader.fieldnames + ["tier 1 genes", "tier 2 genes", "tier 3 genes"]
-        writer = csv.DictWriter(sys.stdout, fieldnames, delimiter="\t")
-        writer.writeheader()
-        for row in reader:
-            chrom = row['chr']
-            start = int(row['start'])
-            end = int(row['end'])
-            if chrom in genes:
-                matches = genes[chrom].find(start, end)
-                if len(matches) > 0:
-                    tier1s = [ s for (s, t) in matches if t == 1]
-                    tier2s = [ s for (s, t) in matches if t == 2]
-                    tier3s = [ s for (s, t) in matches if t == 3]
-                    row["tier 1 genes"] = ";".join(tier1s)
-                    row["tier 2 genes"] = ";".join(tier2s)
-                    row["tier 3 genes"] = ";".join(tier3s)
-                    writer.writerow(row)
+        rows = list(reader)
+    matches = find_gene_matches(genes, rows)
+    writer = csv.DictWriter(sys.stdout, fieldnames, delimiter="\t")
+    writer.writeheader()
+    for index, row in enumerate(rows):
+        if index in matches:
+            row_matches = matches[index]
+            tier1s = [ s for (s, t) in row_matches if t == 1]
+            tier2s = [ s for (s, t) in row_matches if t == 2]
+            tier3s = [ s for (s, t) in row_matches if t == 3]
+            row["tier 1 genes"] = ";".join(tier1s)
+            row["tier 2 genes"] = ";".join(tier2s)
+            row["tier 3 genes"] = ";".join(tier3s)
+            writer.writerow(row)
 
 
 
@@ -16,7 +16,7 @@ import logging
 import pkg_resources
 import networkx as nx
 import csv
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from itertools import combinations
 
 
@@ -117,7 +117,7 @@ CNV = namedtuple('CNV', ['chrom', 'start', 'end', 'copynumber', 'genes', 'penncn
 
 
 def collect_cnvs(pool, cnv_filename, confidence_threshold):
-    families = {}
+    families = defaultdict(lambda: defaultdict(set))
     with open(cnv_filename) as file:
         reader = csv.DictReader(file, delimiter='\t')
         for row in reader:
@@ -125,8 +125,6 @@ def collect_cnvs(pool, cnv_filename, confidence_threshold):
                 this_family = "EVERYONE"
             else:
                 this_family = row['master_sample_sheet_FAMILY_ID']
-            if this_family not in families:
-                families[this_family] = {}
             chroms = families[this_family]
             this_chrom = row['chr']
             this_start = int(row['coord_start'])
@@ -136,8 +134,6 @@ def collect_cnvs(pool, cnv_filename, confidence_threshold):
             this_conf = float(row['penncnv_conf'])
             if this_conf >= confidence_threshold:
                 this_cnv = CNV(this_chrom, this_start, this_end, this_copynumber, this_genes, this_conf)
-                if this_chrom not in chroms:
-                    chroms[this_chrom] = set()
                 chroms[this_chrom].add(this_cnv)
     return families 
 